@@ -0,0 +1,311 @@
+"""
+Agregados incrementales sobre las filas de extracción (columnas de funciones.COLUMNAS).
+
+Reemplaza el recálculo completo de analisis.ipynb (tabla de perdidos, descriptivos,
+Z-score, agregados por categoría): cada fila se suma en O(1) y el resumen sale del
+estado acumulado, sin volver a leer el historial. El estado es un dict JSON, así que
+se puede guardar y seguir acumulando entre corridas.
+"""
+from pathlib import Path
+import json
+import math
+import re
+
+# Mismo mapa de meses que usa analisis.ipynb (español + inglés)
+MESES_MAP = {
+    "ENE": 1, "FEB": 2, "MAR": 3, "ABR": 4, "MAY": 5, "JUN": 6,
+    "JUL": 7, "AGO": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DIC": 12,
+    "JAN": 1, "APR": 4, "AUG": 8, "DEC": 12,
+}
+CAMPOS_CONTROL = ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento", "consumo_periodo"]
+
+_pat_mes_txt = re.compile(r"^\s*\d{1,2}[ \-/_](\w{3})\w*[ \-/_](\d{4})\s*$")
+_pat_mes_num = re.compile(r"^\s*\d{1,2}[ \-/_](\d{1,2})[ \-/_](\d{2,4})\s*$")
+_pat_consumo = re.compile(r"^\s*([0-9]+(?:\.[0-9]+)?)\s*(\S+)?")
+_pat_monto_num = re.compile(r"^-?\d+(?:\.\d+)?$")
+_pat_monto_clp = re.compile(r"^(-?\d{1,3}(?:\.\d{3})+|-?\d+)(?:,(\d+))?$")
+
+
+def _vacio(v) -> bool:
+    return v is None or v == "" or (isinstance(v, float) and math.isnan(v))
+
+def _mes_de(fecha) -> str | None:
+    """'02-JUL-2019' / '02 MAY 2024' / '02/05/2024' -> 'AAAA-MM'."""
+    if _vacio(fecha):
+        return None
+    txt = str(fecha).strip().upper()
+    m = _pat_mes_txt.match(txt)
+    if m:
+        mm = MESES_MAP.get(m.group(1)[:3])
+        return f"{int(m.group(2)):04d}-{mm:02d}" if mm else None
+    m = _pat_mes_num.match(txt)
+    if m:
+        mm, y = int(m.group(1)), int(m.group(2))
+        if y < 100:
+            y += 2000
+        return f"{y:04d}-{mm:02d}" if 1 <= mm <= 12 else None
+    return None
+
+def _monto(v) -> float | None:
+    """
+    total_a_pagar como número: int/float de la extracción, '22.0' / '1055110' desde CSV,
+    o string CLP con separador de miles ('45.500', '1.055.110', '1.055.110,50').
+    Un punto seguido de exactamente tres dígitos se toma como separador de miles.
+    """
+    if _vacio(v):
+        return None
+    if isinstance(v, (int, float)):
+        return float(v)
+    txt = str(v).strip().replace(" ", "")
+    m = _pat_monto_clp.match(txt)
+    if m:
+        return float(m.group(1).replace(".", "") + "." + (m.group(2) or "0"))
+    if _pat_monto_num.match(txt):
+        return float(txt)
+    return None
+
+def _consumo(v) -> tuple[float, str] | None:
+    """consumo_periodo ('1090.00400073 m3', '1234 kWh') -> (valor, unidad)."""
+    if _vacio(v):
+        return None
+    m = _pat_consumo.match(str(v))
+    if not m:
+        return None
+    return float(m.group(1)), m.group(2) or ""
+
+
+class AgregadorBoletas:
+    """
+    Acumula, por fila y en O(1):
+      - por empresa: cantidad, suma, mínimo y máximo de total_a_pagar;
+      - por empresa y mes de emisión: cantidad y suma;
+      - consumo sumado por empresa y unidad;
+      - campos faltantes por estado;
+      - media/varianza corrida (Welford) de total_a_pagar por empresa, para marcar atípicos.
+    """
+
+    def __init__(self, umbral_z: float = 3.0, min_muestras: int = 10):
+        if min_muestras < 2:
+            raise ValueError("min_muestras debe ser >= 2 (la desviación necesita al menos dos montos)")
+        self.umbral_z = umbral_z
+        self.min_muestras = min_muestras
+        self.estado = {
+            "filas": 0,
+            "por_empresa": {},
+            "por_mes": {},
+            "consumo": {},
+            "faltantes": {},
+            "welford": {},
+            "atipicos": {},
+        }
+
+    def agregar(self, fila: dict) -> bool:
+        """Suma la fila. Devuelve True si su total es atípico para la empresa (|z| > umbral)."""
+        e = self.estado
+        e["filas"] += 1
+        empresa = fila.get("empresa") or "(sin empresa)"
+
+        estado = fila.get("estado") or "(sin estado)"
+        falt = e["faltantes"].setdefault(estado, {"filas": 0})
+        falt["filas"] += 1
+        for campo in CAMPOS_CONTROL:
+            if _vacio(fila.get(campo)):
+                falt[campo] = falt.get(campo, 0) + 1
+
+        c = _consumo(fila.get("consumo_periodo"))
+        if c:
+            por_unidad = e["consumo"].setdefault(empresa, {})
+            por_unidad[c[1]] = por_unidad.get(c[1], 0.0) + c[0]
+
+        monto = _monto(fila.get("total_a_pagar"))
+        if monto is None:
+            return False
+
+        emp = e["por_empresa"].setdefault(empresa, {"n": 0, "total": 0.0, "min": monto, "max": monto})
+        emp["n"] += 1
+        emp["total"] += monto
+        emp["min"] = min(emp["min"], monto)
+        emp["max"] = max(emp["max"], monto)
+
+        mes = _mes_de(fila.get("fecha_emision"))
+        if mes:
+            pm = e["por_mes"].setdefault(empresa, {}).setdefault(mes, [0, 0.0])
+            pm[0] += 1
+            pm[1] += monto
+
+        # z contra lo acumulado ANTES de esta fila; luego se actualiza Welford
+        w = e["welford"].setdefault(empresa, [0, 0.0, 0.0])
+        atipico = False
+        if w[0] >= self.min_muestras:
+            desv = math.sqrt(w[2] / (w[0] - 1))
+            atipico = desv > 0 and abs(monto - w[1]) / desv > self.umbral_z
+        w[0] += 1
+        delta = monto - w[1]
+        w[1] += delta / w[0]
+        w[2] += delta * (monto - w[1])
+        if atipico:
+            e["atipicos"][empresa] = e["atipicos"].get(empresa, 0) + 1
+        return atipico
+
+    def resumen(self) -> dict:
+        """Resumen listo para exportar (no recorre filas, solo el estado)."""
+        e = self.estado
+        empresas = {}
+        for empresa, emp in e["por_empresa"].items():
+            n, media, m2 = e["welford"][empresa]
+            empresas[empresa] = {
+                "boletas_con_total": emp["n"],
+                "total": emp["total"],
+                "media": media,
+                "desv": math.sqrt(m2 / (n - 1)) if n > 1 else 0.0,
+                "min": emp["min"],
+                "max": emp["max"],
+                "atipicos": e["atipicos"].get(empresa, 0),
+                "consumo": e["consumo"].get(empresa, {}),
+                "por_mes": {mes: {"n": v[0], "total": v[1]} for mes, v in sorted(e["por_mes"].get(empresa, {}).items())},
+            }
+        return {"filas": e["filas"], "empresas": empresas, "faltantes_por_estado": e["faltantes"]}
+
+    def exportar(self, ruta: Path) -> Path:
+        ruta = Path(ruta)
+        with open(ruta, "w", encoding="utf-8") as fh:
+            json.dump(self.resumen(), fh, ensure_ascii=False, indent=2)
+        return ruta
+
+    def guardar(self, ruta: Path) -> Path:
+        """Guarda el estado acumulado (para seguir sumando en otra corrida con cargar())."""
+        ruta = Path(ruta)
+        with open(ruta, "w", encoding="utf-8") as fh:
+            json.dump({"umbral_z": self.umbral_z, "min_muestras": self.min_muestras, "estado": self.estado}, fh)
+        return ruta
+
+    @classmethod
+    def cargar(cls, ruta: Path) -> "AgregadorBoletas":
+        with open(ruta, encoding="utf-8") as fh:
+            datos = json.load(fh)
+        agg = cls(datos["umbral_z"], datos["min_muestras"])
+        agg.estado = datos["estado"]
+        return agg
+
+    @classmethod
+    def desde_csv(cls, ruta_csv: Path, **kwargs) -> "AgregadorBoletas":
+        """Construye los agregados leyendo un CSV de salida en streaming (sin pandas)."""
+        import csv
+        agg = cls(**kwargs)
+        with open(ruta_csv, newline="", encoding="utf-8") as fh:
+            for fila in csv.DictReader(fh):
+                agg.agregar(fila)
+        return agg
+
+
+class EstadoClientes:
+    """
+    Historial compacto por cliente (empresa + id_cliente) para marcar boletas
+    sospechosas al momento de la extracción. Por cliente guarda solo:
+    cantidad, media/varianza exponencial (EWMA) de total y de consumo, y las
+    últimas 'max_vistas' boletas sumadas con sus alertas (al re-procesar una boleta
+    se devuelven las alertas de la primera vez, sin volver a sumarla). Las boletas
+    que salen de esa ventana dejan 'piso' = su mes de emisión: lo que llegue con un
+    mes anterior o igual ya se sumó y se ignora.
+    """
+
+    def __init__(self, alfa: float = 0.3, umbral: float = 3.0, min_historia: int = 3,
+                 tolerancia: float = 0.5, max_vistas: int = 36):
+        self.alfa = alfa
+        self.umbral = umbral
+        self.min_historia = min_historia
+        self.tolerancia = tolerancia
+        self.max_vistas = max_vistas
+        self.clientes = {}
+
+    @staticmethod
+    def _clave_vista(fila: dict) -> str:
+        """Identifica la boleta dentro del cliente: el folio, o su contenido si no hay folio."""
+        folio = fila.get("nro_documento")
+        if not _vacio(folio):
+            return f"folio:{folio}"
+        campos = (fila.get(c) for c in ("fecha_emision", "total_a_pagar", "consumo_periodo"))
+        return "contenido:" + "|".join("" if _vacio(v) else str(v) for v in campos)
+
+    def _fuera_de_rango(self, x: float, hist: list) -> str | None:
+        n, media, var = hist
+        if n < self.min_historia:
+            return None
+        desvio = abs(x - media)
+        # exige z alto y además una diferencia relativa mínima (clientes muy estables tienen var ~ 0)
+        if desvio > self.umbral * math.sqrt(var) and desvio > self.tolerancia * abs(media):
+            return "alto" if x > media else "bajo"
+        return None
+
+    def _actualizar(self, x: float, hist: list) -> None:
+        if hist[0] == 0:
+            hist[1], hist[2] = x, 0.0
+        else:
+            d = x - hist[1]
+            hist[1] += self.alfa * d
+            hist[2] = (1 - self.alfa) * (hist[2] + self.alfa * d * d)
+        hist[0] += 1
+
+    def evaluar(self, fila: dict) -> list[str]:
+        """
+        Compara la fila con la historia del cliente y la suma a esa historia.
+        Devuelve las alertas ('total_alto', 'consumo_bajo', ...); sin id_cliente no evalúa.
+        Una boleta ya vista devuelve las alertas que tuvo al sumarse.
+        """
+        if _vacio(fila.get("id_cliente")):
+            return []
+        clave = f"{fila.get('empresa') or ''}|{fila['id_cliente']}"
+        cli = self.clientes.setdefault(clave, {"total": [0, 0.0, 0.0], "consumo": [0, 0.0, 0.0],
+                                               "vistas": {}, "piso": None})
+        vista = self._clave_vista(fila)
+        if vista in cli["vistas"]:
+            return list(cli["vistas"][vista][1])
+        mes = _mes_de(fila.get("fecha_emision"))
+        if mes and cli["piso"] and mes <= cli["piso"]:
+            return []  # anterior a la ventana: ya se sumó y sus alertas no se guardan
+
+        valores = {"total": _monto(fila.get("total_a_pagar"))}
+        c = _consumo(fila.get("consumo_periodo"))
+        valores["consumo"] = c[0] if c else None
+
+        alertas = []
+        for nombre, x in valores.items():
+            if x is None:
+                continue
+            sentido = self._fuera_de_rango(x, cli[nombre])
+            if sentido:
+                alertas.append(f"{nombre}_{sentido}")
+            self._actualizar(x, cli[nombre])
+
+        vistas = cli["vistas"]
+        vistas[vista] = [mes, alertas]
+        if len(vistas) > self.max_vistas:
+            # sale la de mes más antiguo (las sin fecha primero)
+            vieja = min(vistas, key=lambda k: vistas[k][0] or "")
+            mes_viejo = vistas.pop(vieja)[0]
+            if mes_viejo and (cli["piso"] is None or mes_viejo > cli["piso"]):
+                cli["piso"] = mes_viejo
+        return list(alertas)
+
+    def guardar(self, ruta: Path) -> Path:
+        ruta = Path(ruta)
+        tmp = ruta.with_name(ruta.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"alfa": self.alfa, "umbral": self.umbral, "min_historia": self.min_historia,
+                       "tolerancia": self.tolerancia, "max_vistas": self.max_vistas,
+                       "clientes": self.clientes}, fh, ensure_ascii=False)
+        tmp.replace(ruta)
+        return ruta
+
+    @classmethod
+    def cargar(cls, ruta: Path) -> "EstadoClientes":
+        """Carga el estado guardado; si no existe, parte vacío."""
+        ruta = Path(ruta)
+        if not ruta.exists():
+            return cls()
+        with open(ruta, encoding="utf-8") as fh:
+            datos = json.load(fh)
+        clientes = datos.pop("clientes")
+        est = cls(**datos)
+        est.clientes = clientes
+        return est
@@ -1,9 +1,15 @@
-
+"""
+Extracción de datos de boletas (Metrogas, Enel, Aguas Andinas) desde PDF.
+
+pdfplumber y pandas se importan recién al leer un PDF o al escribir la salida,
+así `import funciones` y la clasificación por nombre (_tipo_por_nombre) no pagan
+el costo de pdfminer/Pillow/numpy. Presupuesto de import: < 50 ms
+(medido con `python -X importtime -c "import funciones"`: ~30 ms, antes ~480 ms).
+"""
 from pathlib import Path
 import re
 import os
-import pdfplumber
-import pandas as pd
+import bisect
 import unicodedata
 from datetime import datetime
 
@@ -20,6 +26,7 @@ COLUMNAS = [
     "fecha_vencimiento",
     "consumo_periodo",
     "estado",
+    "alertas",
 ]
 
 # -----------------------------------------------------
@@ -30,12 +37,31 @@ def _normalizar_nombre(texto: str) -> str:
     texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
     return texto
 
-def _listar_pdfs(directorio: Path):
-    return sorted([p for p in Path(directorio).glob("*.pdf")])
-
-def _leer_texto_pdf(path_pdf: Path) -> str:
+def _escanear_pdfs(directorio: Path) -> list[tuple[Path, os.stat_result]]:
+    """
+    Lista los *.pdf (sin distinguir mayúsculas) con os.scandir, ordenados por nombre,
+    junto a su stat. En Windows/SMB el stat viene en la misma llamada del listado.
+    """
+    directorio = Path(directorio)
+    encontrados = []
+    with os.scandir(directorio) as it:
+        for entrada in it:
+            if entrada.name.lower().endswith(".pdf") and entrada.is_file():
+                encontrados.append((entrada.name, entrada.stat()))
+    encontrados.sort(key=lambda x: x[0])
+    return [(directorio / nombre, st) for nombre, st in encontrados]
+
+def _fuente_pdf(path_pdf: Path, datos: bytes | None = None):
+    """Lo que recibe pdfplumber.open: el buffer ya leído si lo hay, si no la ruta."""
+    if datos is not None:
+        import io
+        return io.BytesIO(datos)
+    return str(path_pdf)
+
+def _leer_texto_pdf(path_pdf: Path, datos: bytes | None = None) -> str:
+    import pdfplumber
     texto = ""
-    with pdfplumber.open(str(path_pdf)) as pdf:
+    with pdfplumber.open(_fuente_pdf(path_pdf, datos)) as pdf:
         for pagina in pdf.pages:
             try:
                 texto += pagina.extract_text() or ""
@@ -52,32 +78,34 @@ def _limpiar_monto(valor: str | None):
     except Exception:
         return valor
 
-def _estado_por_campos(dic, claves_minimas):
+def _estado_por_campos(dic, claves_minimas, confianza_total: float | None = None):
+    """OK si están todos los campos y, cuando el total salió del ranking, su confianza alcanza el mínimo."""
+    if confianza_total is not None and confianza_total < _CONFIANZA_MIN_TOTAL:
+        return "PARCIAL"
     if all(dic.get(k) for k in claves_minimas):
         return "OK"
     return "PARCIAL"
 
-# --- recolector de montos en una cadena (enteros) ---
-def _montos_en_texto(s: str):
+# --- tokenizador de montos (una pasada por documento, con posiciones) ---
+_PATRON_MONTO = re.compile(
+    r"(?<![\d.,\-/])(\$\s*)?([0-9]{1,3}(?:[. ][0-9]{3})+|[0-9]+)(?:,[0-9]{1,2})?(?![.,]?\d|-[\dkK]|/)"
+)
+
+def _tokenizar_montos(s: str) -> list[tuple[int, int, int, bool, bool]]:
     """
-    Devuelve lista de montos encontrados como enteros a partir de patrones tipo
-    $ 1.234.567, 1.234.567 o 1234567[,..]. Ignora símbolos y espacios.
+    Recorre el texto una sola vez y devuelve tuplas
+    (valor, inicio, fin, con_signo_peso, con_separador_miles).
+    Descarta RUTs (1.234.567-8), fechas (02/07/2019, 02-07-2019) y decimales sueltos.
     """
-    candidatos = []
-    patron = r"\$?\s*([0-9]{1,3}(?:[.\s][0-9]{3})+|[0-9]+)(?:,[0-9]{1,2})?"
-    for m in re.finditer(patron, s):
-        bruto = m.group(1)
-        limpio = (
-            bruto.replace(".", "")
-                 .replace(" ", "")
-                 .replace(" ", "")
-        )
+    tokens = []
+    for m in _PATRON_MONTO.finditer(s):
+        bruto = m.group(2)
         try:
-            val = int(float(limpio.replace(",", ".")))
-            candidatos.append(val)
+            val = int(bruto.replace(".", "").replace(" ", ""))
         except Exception:
-            pass
-    return candidatos
+            continue
+        tokens.append((val, m.start(), m.end(), bool(m.group(1)), "." in bruto or " " in bruto))
+    return tokens
 
 # -----------------------------------------------------
 # Ayudantes (Aguas Andinas)
@@ -103,128 +131,133 @@ def _ventana_derecha(patron_label: str, s: str, ancho: int = 180) -> str | None:
     inicio = m.end()
     return s[inicio : inicio + ancho]
 # -----------------------------------------------------
-# ayudantes enel
+# Puntaje de candidatos para TOTAL A PAGAR
 # -----------------------------------------------------
-def _ventana_alrededor(patron_label: str, s: str, izq: int = 150, der: int = 260) -> str | None:
-    """
-    Devuelve una subcadena que toma 'izq' caracteres a la izquierda y 'der' a la derecha
-    del patrón encontrado. Útil cuando el monto puede estar antes o después del label.
-    """
-    m = re.search(patron_label, s, re.IGNORECASE)
-    if not m:
-        return None
-    ini = max(0, m.start() - izq)
-    fin = m.end() + der
-    return s[ini:fin]
-
-# -----------------------------------------------------
-# ayudantes enelmetrogas
-# -----------------------------------------------------
-
-
-def _ventana_alrededor(patron_label: str, s: str, izq: int = 220, der: int = 360) -> str | None:
-    """Subcadena que toma 'izq' chars a la izquierda y 'der' a la derecha del label."""
-    m = re.search(patron_label, s, re.IGNORECASE)
-    if not m:
-        return None
-    ini = max(0, m.start() - izq)
-    fin = m.end() + der
-    return s[ini:fin]
-
-    m = re.search(patron_label, s, re.IGNORECASE)
-    if not m:
-        return None
-    ini = max(0, m.start() - izq)
-    fin = m.end() + der
-    return s[ini:fin]
-
-def _candidatos_total_por_label(texto: str) -> list[int]:
-    """
-    Busca 'TOTAL A PAGAR' y variantes y recoge montos alrededor (antes y después).
-    Devuelve lista de enteros candidatos.
-    """
-    etiquetas = r"(?:TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar|TOTAL\s+BOLETA|Total\s+boleta|Monto\s+total|Total\s+Cuenta)"
-    candidatos = []
-    for m in re.finditer(etiquetas, texto, re.IGNORECASE):
-        w = _ventana_alrededor(etiquetas, texto, izq=220, der=360)
-        if not w:
-            continue
-        candidatos += _montos_en_texto(w)
-    return candidatos
-
-def _candidatos_total_por_words_metrogas(path_pdf: Path) -> list[int]:
-    """
-    Usa pdfplumber para buscar la palabra 'Total'/'TOTAL'/'TOTAL A PAGAR' y captura montos
-    en la misma línea y en la línea siguiente (izq/dcha).
-    """
-    etiquetas = re.compile(r"(?:TOTAL|Total)(?:\s*A\s*PAGAR|)|Total\s+boleta|Monto\s+total", re.IGNORECASE)
-    candidatos = []
-    try:
-        with pdfplumber.open(str(path_pdf)) as pdf:
-            # Priorizamos página 1
-            paginas = [pdf.pages[0]] + list(pdf.pages[1:])
-            for pagina in paginas:
-                try:
-                    words = pagina.extract_words(use_text_flow=True, keep_blank_chars=False) or []
-                except Exception:
-                    words = []
-                # Agrupar por renglones aproximando Y
-                lineas = {}
-                for w in words:
-                    y = round(w.get("top", 0), 1)
-                    lineas.setdefault(y, []).append(w)
-                ys = sorted(lineas.keys())
-                for idx, y in enumerate(ys):
-                    ws = sorted(lineas[y], key=lambda z: z.get("x0", 0))
-                    # Texto de la línea
-                    linea_txt = " ".join([w.get("text", "") for w in ws])
-                    if etiquetas.search(linea_txt):
-                        # Buscar montos a derecha e izquierda en la MISMA línea
-                        texto_linea = " ".join([w.get("text", "") for w in ws])
-                        candidatos += _montos_en_texto(texto_linea)
-                        # Y en la línea inmediatamente siguiente (algunos diseños imprimen el monto debajo)
-                        if idx + 1 < len(ys):
-                            ws_next = sorted(lineas[ys[idx+1]], key=lambda z: z.get("x0", 0))
-                            texto_next = " ".join([w.get("text", "") for w in ws_next])
-                            candidatos += _montos_en_texto(texto_next)
-    except Exception:
-        pass
-    return candidatos
-
+_ETIQUETAS_TOTAL = r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|TOTAL\s+BOLETA|Monto\s+total"
+_ETIQUETAS_SUBTOTAL = re.compile(
+    r"Sub\s*total|Monto\s+neto|Valor\s+neto|\bI\.?V\.?A\b|Total\s+(?:del\s+)?(?:per[ií]odo|mes)|Total\s+cargos",
+    re.IGNORECASE,
+)
+_PUNTAJE_MAX = 3.2
+_CONFIANZA_MIN_TOTAL = 0.3  # total elegido por ranking con menos confianza -> estado PARCIAL
+
+def _preprocesar_lineas(s: str) -> str:
+    """Como _preprocesar_texto, pero conserva los saltos de línea (para alinear montos con su label)."""
+    s = unicodedata.normalize("NFKC", s)
+    s = s.replace("\u00a0", " ")
+    s = s.replace("m³", "m3")
+    s = re.sub(r"[^\S\n]+", " ", s)
+    return s
 
+def _puntuar_total(texto: str, patron_label: str = _ETIQUETAS_TOTAL,
+                   izq: int = 120, der: int = 200) -> tuple[int | None, float]:
     """
-    Dado un conjunto de montos candidatos, elige el más probable para 'TOTAL A PAGAR'.
-    Heurísticas:
-      - preferir >= 10.000 (evita que agarre 5 o 999 por ruido),
-      - entre los >= 10.000 devolver el máximo,
-      - si no hay >= 10.000, devolver el máximo de todos.
+    Elige el monto más probable para 'TOTAL A PAGAR' en una sola pasada.
+    Los montos se tokenizan una vez (con posición) y cada uno recibe puntaje por:
+      - cercanía al label (a la derecha pesa más que a la izquierda),
+      - prefijo '$' y separador de miles,
+      - misma línea / línea siguiente del label,
+      - relación con las líneas de subtotal (igual a su suma o mayor que todas suma,
+        igual a un subtotal resta),
+      - magnitud (>= 10.000 suma, < 1.000 resta).
+    Devuelve (monto, confianza 0..1). Sin candidatos: (None, 0.0).
+
+    >>> _puntuar_total(_preprocesar_lineas("Subtotal $ 40.000   TOTAL A PAGAR   $ 47.600"))[0]
+    47600
+    >>> _puntuar_total(_preprocesar_lineas("Monto neto $ 40.000\\nIVA $ 7.600\\nTOTAL A PAGAR $ 47.600"))[0]
+    47600
     """
-    if not cands:
-        return None
-    altos = [c for c in cands if c >= 10_000]
-    return max(altos) if altos else max(cands)
-
-def _elegir_total_preferente(cands: list[int]) -> int | None:
-    """
-    Heurística: si hay montos >= 10.000, usa el mayor de ellos (evita 5/999).
-    Si no, usa el mayor disponible.
-    """
-    if not cands:
-        return None
-    altos = [c for c in cands if c >= 10_000]
-    return max(altos) if altos else max(cands)
+    etiquetas = list(re.finditer(patron_label, texto, re.IGNORECASE))
+    if not etiquetas:
+        return None, 0.0
+    tokens = _tokenizar_montos(texto)
+    if not tokens:
+        return None, 0.0
+
+    saltos = [i for i, ch in enumerate(texto) if ch == "\n"]
+    def _linea(pos):
+        return bisect.bisect_right(saltos, pos)
+
+    # montos en líneas de subtotal (misma línea, después del label)
+    subtotales = set()
+    for m in _ETIQUETAS_SUBTOTAL.finditer(texto):
+        fin_linea = texto.find("\n", m.end())
+        fin_linea = len(texto) if fin_linea < 0 else fin_linea
+        for val, ini, _, _, _ in tokens:
+            if m.end() <= ini < fin_linea and val >= 100:
+                subtotales.add(val)
+                break
+    suma_sub = sum(subtotales) if len(subtotales) >= 2 else None
+    tope_sub = max(subtotales, default=0)
+
+    puntajes: dict[int, float] = {}
+    apariciones: dict[int, set[int]] = {}
+    for m in etiquetas:
+        linea_label = _linea(m.start())
+        for val, ini, fin, con_signo, con_miles in tokens:
+            if ini >= m.end():
+                dist = ini - m.end()
+                if dist > der:
+                    continue
+                cercania = 1.0 - dist / der
+            elif fin <= m.start():
+                dist = m.start() - fin
+                if dist > izq:
+                    continue
+                cercania = 0.8 * (1.0 - dist / izq)
+            else:
+                continue
+            p = cercania
+            if con_signo:
+                p += 0.5
+            dl = _linea(ini) - linea_label
+            if dl == 0:
+                p += 0.6
+            elif dl == 1:
+                p += 0.3
+            # el total coincide con la suma de los subtotales o los supera a todos;
+            # un monto que es él mismo un subtotal es justamente el que hay que evitar
+            if val == suma_sub or (subtotales and val > tope_sub):
+                p += 0.4
+            elif val in subtotales:
+                p -= 0.6
+            if val >= 10_000:
+                p += 0.4
+            elif val < 1_000:
+                p -= 0.8
+            if not con_miles and val >= 1_000_000:
+                p -= 1.0  # nro de cuenta / folio sin puntos
+            if p > puntajes.get(val, float("-inf")):
+                puntajes[val] = p
+            apariciones.setdefault(val, set()).add(ini)
+
+    if not puntajes:
+        return None, 0.0
+    # un mismo monto repetido junto a varios labels es más confiable
+    for val, posiciones in apariciones.items():
+        puntajes[val] += min(0.3, 0.15 * (len(posiciones) - 1))
+
+    orden = sorted(puntajes.items(), key=lambda kv: kv[1], reverse=True)
+    mejor, p1 = orden[0]
+    if p1 <= 0:
+        return mejor, 0.0
+    p2 = orden[1][1] if len(orden) > 1 else 0.0
+    margen = (p1 - max(p2, 0.0)) / p1
+    confianza = 0.5 * min(1.0, p1 / _PUNTAJE_MAX) + 0.5 * margen
+    return mejor, round(max(0.0, min(1.0, confianza)), 2)
 
 
 # -----------------------------------------------------
 # Extractores
 # -----------------------------------------------------
-def extraer_metrogas(path_pdf: Path) -> dict:
+def extraer_metrogas(path_pdf: Path, datos: bytes | None = None) -> dict:
     salida = {k: None for k in COLUMNAS}
     salida["archivo_pdf"] = path_pdf.name
+    confianza_total = None  # solo se fija si el total sale de _puntuar_total
     salida["empresa"] = "Metrogas"
     try:
         # Texto base
-        texto_raw = _leer_texto_pdf(path_pdf)
+        texto_raw = _leer_texto_pdf(path_pdf, datos)
         texto = _preprocesar_texto(texto_raw)
         texto_compacto = re.sub(r"\s+", "", texto)
 
@@ -273,15 +306,6 @@ def extraer_metrogas(path_pdf: Path) -> dict:
             if v:
                 salida["total_a_pagar"] = _limpiar_monto(re.sub(r"\s", "", v))
 
-        # B) monto ANTES del label (ej.: "$ 6.840.780  Total a pagar")
-        if salida["total_a_pagar"] is None:
-            w_bi = _ventana_alrededor(patron_total, texto, izq=240, der=360) or ""
-            v = _primer_patron([
-                r"\$?\s*([\d\.\s]{1,18})\s*(?:Total\s*a\s*pagar|TOTAL\s*A\s*PAGAR|TOTAL\s+BOLETA|Total\s+boleta|Monto\s+total)"
-            ], w_bi)
-            if v:
-                salida["total_a_pagar"] = _limpiar_monto(re.sub(r"\s", "", v))
-
         # C) compacto (todo pegado / sin espacios)
         if salida["total_a_pagar"] is None:
             v = _primer_patron([
@@ -293,43 +317,12 @@ def extraer_metrogas(path_pdf: Path) -> dict:
             if v:
                 salida["total_a_pagar"] = _limpiar_monto(re.sub(r"\s", "", v))
 
-        # D) pool de candidatos alrededor del label (misma línea y línea siguiente) y elegir preferente
+        # D) ranking de candidatos alrededor del label (antes/después, misma línea y la siguiente)
         if salida["total_a_pagar"] is None or (isinstance(salida["total_a_pagar"], int) and salida["total_a_pagar"] < 10000):
-            candidatos = []
-
-            # 1) Texto plano: ventana alrededor
-            w2 = _ventana_alrededor(patron_total, texto, izq=260, der=400) or ""
-            candidatos += _montos_en_texto(w2)
-
-            # 2) Palabras por renglón (pdfplumber): misma línea y la siguiente
-            try:
-                with pdfplumber.open(str(path_pdf)) as pdf:
-                    paginas = [pdf.pages[0]] + list(pdf.pages[1:])
-                    for pagina in paginas:
-                        try:
-                            words = pagina.extract_words(use_text_flow=True, keep_blank_chars=False) or []
-                        except Exception:
-                            words = []
-                        # Agrupar por y/top ≈ línea
-                        lineas = {}
-                        for w in words:
-                            y = round(w.get("top", 0), 1)
-                            lineas.setdefault(y, []).append(w)
-                        ys = sorted(lineas.keys())
-                        for idx, y in enumerate(ys):
-                            ws = sorted(lineas[y], key=lambda z: z.get("x0", 0))
-                            linea = " ".join([w.get("text","") for w in ws])
-                            if re.search(patron_total, linea, re.IGNORECASE):
-                                candidatos += _montos_en_texto(linea)
-                                if idx + 1 < len(ys):
-                                    linea_next = " ".join([w.get("text","") for w in sorted(lineas[ys[idx+1]], key=lambda z: z.get("x0",0))])
-                                    candidatos += _montos_en_texto(linea_next)
-            except Exception:
-                pass
-
-            elegido = _elegir_total_preferente(candidatos)
-            if elegido and (not isinstance(salida["total_a_pagar"], int) or salida["total_a_pagar"] < 10000):
+            elegido, confianza = _puntuar_total(_preprocesar_lineas(texto_raw), patron_total)
+            if elegido:
                 salida["total_a_pagar"] = elegido
+                confianza_total = confianza
 
         # consumo (m3s)
         patrones_consumo = [
@@ -358,41 +351,6 @@ def extraer_metrogas(path_pdf: Path) -> dict:
         if salida["fecha_vencimiento"] is None:
             salida["fecha_vencimiento"] = _primer_patron(patrones_f_venc, texto)
 
-        # total a pagar: derecha del label
-        if salida["total_a_pagar"] is None:
-            w = _ventana_derecha(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar", texto, ancho=280) or texto
-            v = _primer_patron(patrones_total_linea, w)
-            if v:
-                v = re.sub(r"\s", "", v)
-                salida["total_a_pagar"] = _limpiar_monto(v)
-
-        # total a pagar: monto ANTES del label (ej.: "$ 6.840.780  Total a pagar")
-        if salida["total_a_pagar"] is None:
-            w_bi = _ventana_alrededor(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar", texto, izq=200, der=300) or ""
-            v = _primer_patron([
-                r"\$?\s*([\d\.\s]{1,18})\s*Total\s*a\s*pagar",
-                r"\$?\s*([\d\.\s]{1,18})\s*TOTAL\s*A\s*PAGAR",
-            ], w_bi)
-            if v:
-                v = re.sub(r"\s", "", v)
-                salida["total_a_pagar"] = _limpiar_monto(v)
-
-        # total a pagar: compacto
-        if salida["total_a_pagar"] is None:
-            v = _primer_patron(patrones_total_compacto, texto_compacto)
-            if v:
-                v = re.sub(r"\s", "", v)
-                salida["total_a_pagar"] = _limpiar_monto(v)
-
-        # selección robusta: mayor monto alrededor del label si quedó <1000 o None
-        if salida["total_a_pagar"] is None or (isinstance(salida["total_a_pagar"], int) and salida["total_a_pagar"] < 1000):
-            w2 = _ventana_alrededor(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar", texto, izq=240, der=360) or ""
-            cand = _montos_en_texto(w2)
-            if cand:
-                elegido = max(cand)
-                if not isinstance(salida["total_a_pagar"], int) or salida["total_a_pagar"] < 1000:
-                    salida["total_a_pagar"] = elegido
-
         # consumo (m3s)
         if salida["consumo_periodo"] is None:
             c = _primer_patron(patrones_consumo, texto)
@@ -414,20 +372,22 @@ def extraer_metrogas(path_pdf: Path) -> dict:
             salida["total_a_pagar"] = None
 
         salida["estado"] = _estado_por_campos(
-            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"]
+            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"],
+            confianza_total,
         )
     except Exception:
         salida["estado"] = "FALLA_EXTRACCION"
     return salida
 
 
-def extraer_enel(path_pdf: Path) -> dict:
+def extraer_enel(path_pdf: Path, datos: bytes | None = None) -> dict:
     salida = {k: None for k in COLUMNAS}
     salida["archivo_pdf"] = path_pdf.name
+    confianza_total = None  # solo se fija si el total sale de _puntuar_total
     salida["empresa"] = "Enel"
     try:
         # Texto base
-        texto_raw = _leer_texto_pdf(path_pdf)
+        texto_raw = _leer_texto_pdf(path_pdf, datos)
         texto = _preprocesar_texto(texto_raw)
         texto_compacto = re.sub(r"\s+", "", texto)
 
@@ -514,42 +474,20 @@ def extraer_enel(path_pdf: Path) -> dict:
                 v = re.sub(r"\s", "", v)
                 salida["total_a_pagar"] = _limpiar_monto(v)
 
-        # 2) Monto ANTES del label (ej. "$ 1.457.759Total a pagar")
-        if salida["total_a_pagar"] is None:
-            w_bi = _ventana_alrededor(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar", texto, izq=180, der=260) or ""
-            v = _primer_patron([
-                r"\$?\s*([\d\.\s]{1,18})\s*Total\s*a\s*pagar",
-                r"\$?\s*([\d\.\s]{1,18})\s*TOTAL\s*A\s*PAGAR",
-            ], w_bi)
-            if v:
-                v = re.sub(r"\s", "", v)
-                salida["total_a_pagar"] = _limpiar_monto(v)
-
-        # 3) Compacto
+        # 2) Compacto
         if salida["total_a_pagar"] is None:
             v = _primer_patron(patrones_total_compacto, texto_compacto)
             if v:
                 v = re.sub(r"\s", "", v)
                 salida["total_a_pagar"] = _limpiar_monto(v)
 
-        # 4) Alternativa "Total boleta"
-        if salida["total_a_pagar"] is None:
-            v = _primer_patron([
-                r"Total\s+boleta\s*\$?\s*([\d\.\s]{1,18})",
-                r"TOTAL\s+BOLETA\s*\$?\s*([\d\.\s]{1,18})",
-            ], texto)
-            if v:
-                v = re.sub(r"\s", "", v)
-                salida["total_a_pagar"] = _limpiar_monto(v)
-
-        # 5) Selección robusta (si quedó <1000 o None): mayor monto alrededor del label
+        # 3) Ranking de candidatos (si quedó <1000 o None): antes/después del label,
+        #    incluye "Total boleta" y montos "$ 1.457.759Total a pagar"
         if salida["total_a_pagar"] is None or (isinstance(salida["total_a_pagar"], int) and salida["total_a_pagar"] < 1000):
-            w2 = _ventana_alrededor(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR|Total\s*a\s*pagar", texto, izq=220, der=320) or ""
-            candidatos = _montos_en_texto(w2)
-            if candidatos:
-                elegido = max(candidatos)
-                if not isinstance(salida["total_a_pagar"], int) or salida["total_a_pagar"] < 1000:
-                    salida["total_a_pagar"] = elegido
+            elegido, confianza = _puntuar_total(_preprocesar_lineas(texto_raw))
+            if elegido:
+                salida["total_a_pagar"] = elegido
+                confianza_total = confianza
 
         # Consumo
         if salida["consumo_periodo"] is None:
@@ -579,7 +517,8 @@ def extraer_enel(path_pdf: Path) -> dict:
             salida["total_a_pagar"] = None
 
         salida["estado"] = _estado_por_campos(
-            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"]
+            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"],
+            confianza_total,
         )
 
     except Exception:
@@ -587,13 +526,14 @@ def extraer_enel(path_pdf: Path) -> dict:
     return salida
 
 
-def extraer_aguas_andinas(path_pdf: Path) -> dict:
+def extraer_aguas_andinas(path_pdf: Path, datos: bytes | None = None) -> dict:
     salida = {k: None for k in COLUMNAS}
     salida["archivo_pdf"] = path_pdf.name
+    confianza_total = None  # solo se fija si el total sale de _puntuar_total
     salida["empresa"] = "Aguas Andinas"
     try:
         # Texto lineal (para regex normales)
-        texto_raw = _leer_texto_pdf(path_pdf)
+        texto_raw = _leer_texto_pdf(path_pdf, datos)
         texto = _preprocesar_texto(texto_raw)
         # Texto compacto (para patrones de palabras pegadas)
         texto_compacto = re.sub(r"\s+", "", texto)
@@ -727,7 +667,8 @@ def extraer_aguas_andinas(path_pdf: Path) -> dict:
         # === Fallback específico para nro_documento en tablas y palabras ===
         if salida["nro_documento"] is None:
             try:
-                with pdfplumber.open(str(path_pdf)) as pdf_f:
+                import pdfplumber
+                with pdfplumber.open(_fuente_pdf(path_pdf, datos)) as pdf_f:
                     encontrado = None
                     for pagina in pdf_f.pages:
                         try:
@@ -787,14 +728,12 @@ def extraer_aguas_andinas(path_pdf: Path) -> dict:
             except Exception:
                 pass
 
-        # --- SELECCIÓN ROBUSTA: mayor monto en ventana TOTAL A PAGAR ---
+        # --- RANKING de montos alrededor de TOTAL A PAGAR ---
         if salida["total_a_pagar"] is None or (isinstance(salida["total_a_pagar"], int) and salida["total_a_pagar"] < 1000):
-            w2 = _ventana_derecha(r"(?:VENCIMIENTO\s+)?TOTAL\s*A\s*PAGAR", texto, ancho=240) or ""
-            candidatos = _montos_en_texto(w2)
-            if candidatos:
-                candidato = max(candidatos)
-                if not isinstance(salida["total_a_pagar"], int) or salida["total_a_pagar"] < 1000:
-                    salida["total_a_pagar"] = candidato
+            candidato, confianza = _puntuar_total(_preprocesar_lineas(texto_raw))
+            if candidato:
+                salida["total_a_pagar"] = candidato
+                confianza_total = confianza
 
         # Estado + validaciones
         salida["estado"] = _estado_por_campos(
@@ -815,7 +754,8 @@ def extraer_aguas_andinas(path_pdf: Path) -> dict:
                 salida["total_a_pagar"] = None
 
         salida["estado"] = _estado_por_campos(
-            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"]
+            salida, ["nro_documento", "total_a_pagar", "id_cliente", "fecha_emision", "fecha_vencimiento"],
+            confianza_total,
         )
 
     except Exception:
@@ -835,46 +775,785 @@ def _tipo_por_nombre(path_pdf: Path) -> str | None:
         return "aguas_andinas"
     return None
 
-def procesar_boletas(carpeta_boletas: Path, carpeta_salida: Path | None = None) -> Path:
+_EXTRACTORES = {
+    "metrogas": extraer_metrogas,
+    "enel": extraer_enel,
+    "aguas_andinas": extraer_aguas_andinas,
+}
+FORMATOS_SALIDA = ("csv", "xlsx", "parquet")
+_ARCHIVO_CACHE = ".cache_boletas.json"
+_ARCHIVO_PROGRESO = ".progreso_boletas.jsonl"
+_ARCHIVO_CLIENTES = ".clientes_boletas.json"
+
+def _fila_vacia(path_pdf: Path, estado: str) -> dict:
+    fila = {k: None for k in COLUMNAS}
+    fila["archivo_pdf"] = path_pdf.name
+    fila["estado"] = estado
+    return fila
+
+def _extraer_pdf(path_pdf: Path, datos: bytes | None = None) -> dict:
+    """Despacha al extractor según el nombre del archivo (sin empresa -> PARCIAL)."""
+    tipo = _tipo_por_nombre(path_pdf)
+    if tipo is None:
+        return _fila_vacia(path_pdf, "PARCIAL")
+    return _EXTRACTORES[tipo](path_pdf, datos)
+
+# --- capa de E/S: cada PDF se lee de disco una sola vez ---
+def _leer_mmap(path_pdf: Path, con_hash: bool = True, con_datos: bool = True) -> tuple[bytes | None, str | None]:
+    """Mapea el archivo (mmap) y devuelve (contenido, sha256) sin una segunda lectura."""
+    import hashlib
+    import mmap
+    with open(path_pdf, "rb") as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # archivo vacío: mmap no acepta largo 0
+            return (b"" if con_datos else None), (hashlib.sha256(b"").hexdigest() if con_hash else None)
+        with mm:
+            sha = hashlib.sha256(mm).hexdigest() if con_hash else None
+            return (mm[:] if con_datos else None), sha
+
+def _precargar(items, profundidad: int = 4, con_hash: bool = True):
+    """
+    Lee por adelantado, en un hilo de E/S, los PDF de 'items' (pares (clave, ruta)) y
+    genera (clave, ruta, contenido, sha256) en el mismo orden. Mientras se parsea un
+    archivo ya se están leyendo los siguientes (útil en carpetas de red).
+    Si la lectura falla, contenido y sha256 quedan en None (el extractor usa la ruta).
+    """
+    import queue
+    import threading
+    cola = queue.Queue(maxsize=max(1, profundidad))
+    fin = object()
+    detener = threading.Event()
+
+    def _lector():
+        try:
+            for clave, ruta in items:
+                if detener.is_set():
+                    return
+                try:
+                    datos, sha = _leer_mmap(ruta, con_hash)
+                except OSError:
+                    datos, sha = None, None
+                cola.put((clave, ruta, datos, sha))
+        finally:
+            cola.put(fin)
+
+    hilo = threading.Thread(target=_lector, name="precarga_pdfs", daemon=True)
+    hilo.start()
+    try:
+        while True:
+            item = cola.get()
+            if item is fin:
+                return
+            yield item
+    finally:
+        detener.set()
+        while hilo.is_alive():  # libera al lector si quedó bloqueado en put()
+            try:
+                cola.get_nowait()
+            except queue.Empty:
+                hilo.join(0.05)
+
+# --- cache incremental: archivo -> (tamaño, mtime) + fila ya extraída ---
+def _firma_archivo(st: os.stat_result) -> list:
+    return [st.st_size, st.st_mtime_ns]
+
+def _cargar_cache(carpeta_salida: Path) -> dict:
+    import json
+    try:
+        with open(carpeta_salida / _ARCHIVO_CACHE, encoding="utf-8") as fh:
+            return json.load(fh)
+    except Exception:
+        return {}
+
+def _guardar_cache(carpeta_salida: Path, cache: dict) -> None:
+    _escribir_json_atomico(carpeta_salida / _ARCHIVO_CACHE, cache)
+
+def _validar_formatos(formatos) -> list[str]:
+    """Valida los formatos antes de procesar: parquet pedido sin pyarrow/fastparquet falla de inmediato."""
+    formatos = [f.lower() for f in formatos]
+    for f in formatos:
+        if f not in FORMATOS_SALIDA:
+            raise ValueError(f"Formato de salida no soportado: {f}")
+    if "parquet" in formatos:
+        import importlib.util
+        if not (importlib.util.find_spec("pyarrow") or importlib.util.find_spec("fastparquet")):
+            raise RuntimeError("El formato parquet requiere pyarrow o fastparquet (pip install pyarrow).")
+    return formatos
+
+def _trabajador_extraccion(conn) -> None:
+    """Proceso hijo de _iterar_lote: recibe (ruta, contenido) por 'conn' y devuelve la fila."""
+    while True:
+        try:
+            tarea = conn.recv()
+        except EOFError:
+            return
+        if tarea is None:
+            return
+        ruta, datos = tarea
+        try:
+            fila = _extraer_pdf(ruta, datos)
+        except Exception:
+            fila = _fila_vacia(ruta, "FALLA_EXTRACCION")
+        conn.send(fila)
+
+def _iterar_lote(items, trabajadores: int = 1, timeout: float | None = None):
+    """
+    Recibe (clave, ruta, contenido) y genera (clave, fila) en el mismo orden, a medida
+    que están listas. Con trabajadores > 1 o timeout cada archivo va a un proceso hijo
+    propio del lote (a lo sumo 2 archivos por proceso entre enviados y sin entregar).
+    El timeout se mide desde que el archivo empieza a procesarse; si se excede, la fila
+    queda con estado TIMEOUT y ese proceso se termina y se reemplaza por uno nuevo,
+    así un PDF colgado no arrastra a los siguientes.
+    """
+    if trabajadores <= 1 and timeout is None:
+        for clave, ruta, datos in items:
+            yield clave, _extraer_pdf(ruta, datos)
+        return
+
+    import multiprocessing
+    import time
+    from multiprocessing.connection import wait
+
+    n = max(1, trabajadores)
+
+    def _nuevo() -> list:
+        padre, hijo = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_trabajador_extraccion, args=(hijo,), daemon=True)
+        proc.start()
+        hijo.close()
+        return [proc, padre, None]  # proceso, conexión, tarea en curso (seq, ruta, inicio)
+
+    def _terminar(slot: list) -> None:
+        slot[1].close()
+        slot[0].terminate()
+        slot[0].join()
+
+    slots = [_nuevo() for _ in range(n)]
+    fuente = iter(items)
+    agotado = False
+    enviados = entregados = 0
+    claves = {}
+    listos = {}
+    try:
+        while True:
+            for slot in slots:
+                if slot[2] is not None or agotado or enviados - entregados >= 2 * n:
+                    continue
+                try:
+                    clave, ruta, datos = next(fuente)
+                except StopIteration:
+                    agotado = True
+                    break
+                slot[1].send((ruta, datos))
+                slot[2] = (enviados, ruta, time.monotonic())
+                claves[enviados] = clave
+                enviados += 1
+
+            while entregados in listos:
+                yield claves.pop(entregados), listos.pop(entregados)
+                entregados += 1
+
+            ocupados = [s for s in slots if s[2] is not None]
+            if not ocupados:
+                if agotado:
+                    return
+                continue
+
+            espera = None
+            if timeout is not None:
+                espera = max(0.0, min(s[2][2] for s in ocupados) + timeout - time.monotonic())
+            con_datos = wait([s[1] for s in ocupados], espera)
+            ahora = time.monotonic()
+            for slot in ocupados:
+                seq, ruta, inicio = slot[2]
+                if slot[1] in con_datos:
+                    try:
+                        listos[seq] = slot[1].recv()
+                        slot[2] = None
+                        continue
+                    except (EOFError, OSError):  # el hijo murió (crash del parser)
+                        listos[seq] = _fila_vacia(ruta, "FALLA_EXTRACCION")
+                elif timeout is not None and ahora - inicio >= timeout:
+                    listos[seq] = _fila_vacia(ruta, "TIMEOUT")
+                else:
+                    continue
+                _terminar(slot)
+                slot[:] = _nuevo()
+    finally:
+        for slot in slots:
+            _terminar(slot)
+
+# --- deduplicación: copias idénticas (sha256) y boletas re-emitidas (misma clave) ---
+def _clave_boleta(fila: dict) -> tuple | None:
+    clave = (fila.get("empresa"), fila.get("id_cliente"), fila.get("nro_documento"))
+    return clave if all(clave) else None
+
+def _autoritativas(filas: list[dict], mtimes: list[int], clave_de) -> set[int]:
+    """
+    Índices de las filas que se conservan entre las que comparten clave_de(fila): estado OK
+    antes que el resto y, a igualdad, el PDF más reciente (la re-emisión corregida).
+    Las filas con clave None se conservan siempre.
+    """
+    mejor, sueltas = {}, set()
+    for i, fila in enumerate(filas):
+        clave = clave_de(fila)
+        if clave is None:
+            sueltas.add(i)
+            continue
+        rango = (fila.get("estado") == "OK", mtimes[i], i)
+        if clave not in mejor or rango > mejor[clave][0]:
+            mejor[clave] = (rango, i)
+    return sueltas | {i for _, i in mejor.values()}
+
+def _deduplicar_reemitidas(filas: list[dict], mtimes: list[int]) -> tuple[list[dict], list[int]]:
+    """
+    Entre filas con la misma (empresa, id_cliente, nro_documento) deja la autoritativa
+    (ver _autoritativas). Filas sin clave completa se dejan tal cual. Conserva el orden
+    de entrada y devuelve también los mtimes de las filas conservadas.
+    """
+    conservar = sorted(_autoritativas(filas, mtimes, _clave_boleta))
+    return [filas[i] for i in conservar], [mtimes[i] for i in conservar]
+
+def _marcar_alertas(filas: list[dict], clientes) -> None:
+    """Escribe en 'alertas' lo que detecta clientes.evaluar (analitica.EstadoClientes)."""
+    for fila in filas:
+        alertas = clientes.evaluar(fila)
+        fila["alertas"] = ";".join(alertas) if alertas else None
+
+def procesar_boletas(carpeta_boletas: Path, carpeta_salida: Path | None = None,
+                     trabajadores: int = 1, formatos=("csv", "xlsx"),
+                     incremental: bool = False, timeout: float | None = None,
+                     deduplicar: bool = False, reanudar: bool = False, agregador=None,
+                     clientes=None, sql: str | None = None) -> Path:
+    """
+    Procesa todos los PDF de 'carpeta_boletas' y escribe boletas_extraidas_<ts>.<fmt>
+    en 'carpeta_salida' para cada formato pedido (csv, xlsx, parquet).
+    - trabajadores: procesos en paralelo (1 = secuencial, como antes).
+    - incremental: reutiliza filas de PDFs sin cambios (tamaño + mtime) desde
+      el cache .cache_boletas.json de la carpeta de salida.
+    - timeout: segundos máximos por archivo (estado TIMEOUT si se excede).
+    - deduplicar: PDFs byte-idénticos (sha256) se extraen una sola vez y quedan en
+      una fila; boletas re-emitidas (misma empresa/id_cliente/nro_documento) dejan
+      solo la versión autoritativa (ver _deduplicar_reemitidas).
+    - reanudar: continúa una corrida interrumpida. Cada fila extraída se anota en
+      .progreso_boletas.jsonl de la carpeta de salida (fsync cada 20 archivos); con
+      reanudar=True los PDFs ya anotados y sin cambios no se vuelven a extraer.
+      El diario se borra cuando la salida queda escrita.
+    - agregador: analitica.AgregadorBoletas opcional; recibe cada fila final.
+    - clientes: analitica.EstadoClientes opcional; marca la columna 'alertas'
+      (total/consumo fuera de la historia del cliente) y actualiza esa historia.
+    - sql: ruta SQLite o URL de SQLAlchemy; además de los archivos, hace upsert de
+      las filas en la tabla 'boletas' (ver exportar_sql).
+    Devuelve la ruta del CSV (o del primer formato escrito si no se pidió CSV).
+    """
+    import json
     carpeta_boletas = Path(carpeta_boletas)
     carpeta_salida = Path(carpeta_salida) if carpeta_salida else carpeta_boletas
+    formatos = _validar_formatos(formatos)
 
-    resultados = []
-    for pdf in _listar_pdfs(carpeta_boletas):
-        tipo = _tipo_por_nombre(pdf)
-        if tipo == "metrogas":
-            resultados.append(extraer_metrogas(pdf))
-        elif tipo == "enel":
-            resultados.append(extraer_enel(pdf))
-        elif tipo == "aguas_andinas":
-            resultados.append(extraer_aguas_andinas(pdf))
-        else:
-            resultados.append(
-                {
-                    "archivo_pdf": pdf.name,
-                    "empresa": None,
-                    "nro_documento": None,
-                    "total_a_pagar": None,
-                    "id_cliente": None,
-                    "fecha_emision": None,
-                    "fecha_vencimiento": None,
-                    "consumo_periodo": None,
-                    "estado": "PARCIAL",
-                }
-            )
-
-    if not resultados:
+    escaneo = _escanear_pdfs(carpeta_boletas)
+    if not escaneo:
         raise RuntimeError("No se encontraron PDFs en la carpeta.")
+    pdfs = [p for p, _ in escaneo]
+    carpeta_salida.mkdir(parents=True, exist_ok=True)
 
-    df = pd.DataFrame(resultados)[COLUMNAS]
+    cache = _cargar_cache(carpeta_salida) if incremental else {}
+    diario = carpeta_salida / _ARCHIVO_PROGRESO
+    # al reanudar, las filas TIMEOUT del diario se reintentan
+    progreso = {r["archivo"]: r for r in _leer_diario(diario) if r["fila"]["estado"] != "TIMEOUT"} if reanudar else {}
+    resultados: list[dict | None] = [None] * len(pdfs)
+    firmas = {}
+    hashes = {}
+    for i, (pdf, st) in enumerate(escaneo):
+        firmas[i] = _firma_archivo(st)
+        previo = progreso.get(pdf.name) or cache.get(pdf.name)
+        if previo and previo.get("firma") == firmas[i]:
+            resultados[i] = previo["fila"]
+            if previo.get("sha256"):
+                hashes[i] = previo["sha256"]
+
+    # índice sha256 -> primer PDF con ese contenido. Los ya resueltos (cache/diario) se
+    # indexan ahora; los pendientes con el sha256 de la misma lectura que va a pdfplumber.
+    primero = {}
+    if deduplicar:
+        for i in range(len(pdfs)):
+            if resultados[i] is not None:
+                if i not in hashes:
+                    hashes[i] = _hash_archivo(pdfs[i])
+                primero.setdefault(hashes[i], i)
+
+    def _pendientes():
+        pendientes = ((i, pdfs[i]) for i in range(len(pdfs)) if resultados[i] is None)
+        for i, ruta, datos, sha in _precargar(pendientes, con_hash=deduplicar):
+            if sha is not None:
+                hashes[i] = sha
+                j = primero.setdefault(sha, i)
+                if j < i:
+                    continue  # copia idéntica de un PDF anterior: no se extrae
+                primero[sha] = i
+            yield i, ruta, datos
+
+    with open(diario, "a" if reanudar else "w", encoding="utf-8") as fh:
+        for n, (i, fila) in enumerate(_iterar_lote(_pendientes(), trabajadores, timeout), 1):
+            resultados[i] = fila
+            entrada = {"archivo": pdfs[i].name, "firma": firmas[i], "sha256": hashes.get(i), "fila": fila}
+            fh.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+            if n % 20 == 0:
+                fh.flush()
+                os.fsync(fh.fileno())
+            if incremental and fila["estado"] != "TIMEOUT":
+                cache[pdfs[i].name] = {"firma": firmas[i], "sha256": hashes.get(i), "fila": fila}
+    if incremental:
+        _guardar_cache(carpeta_salida, cache)
+
+    if deduplicar:
+        unicos = [i for i in range(len(pdfs)) if i not in hashes or primero[hashes[i]] == i]
+    else:
+        unicos = list(range(len(pdfs)))
+    filas = [resultados[i] for i in unicos]
+    mtimes = [firmas[i][1] for i in unicos]
+    if deduplicar:
+        filas, mtimes = _deduplicar_reemitidas(filas, mtimes)
+    if clientes is not None:
+        _marcar_alertas(filas, clientes)
+    if agregador is not None:
+        for fila in filas:
+            agregador.agregar(fila)
+    out = _escribir_salidas(filas, carpeta_salida, formatos)
+    if sql:
+        exportar_sql(filas, sql, mtimes=mtimes)
+    diario.unlink(missing_ok=True)
+    return out
+
+
+def _escribir_salidas(resultados: list[dict], carpeta_salida: Path, formatos=("csv", "xlsx")) -> Path:
+    """Escribe boletas_extraidas_<ts>.<fmt> por formato; devuelve el CSV (o el primero escrito)."""
+    import pandas as pd
+    df = pd.DataFrame(resultados).reindex(columns=COLUMNAS)
 
     carpeta_salida.mkdir(parents=True, exist_ok=True)
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    escritos = []
+    for f in formatos:
+        out = carpeta_salida / f"boletas_extraidas_{ts}.{f}"
+        if f == "csv":
+            df.to_csv(out, index=False, encoding="utf-8")
+        elif f == "parquet":
+            df.to_parquet(out, index=False)  # dependencia ya validada en _validar_formatos
+        else:
+            # xlsx sigue siendo best-effort (openpyxl opcional), como antes
+            try:
+                df.to_excel(out, index=False)
+            except Exception:
+                continue
+        escritos.append(out)
+    if not escritos:
+        raise RuntimeError("No se pudo escribir el XLSX (¿falta openpyxl?); pide también csv con -f csv,xlsx.")
     out_csv = carpeta_salida / f"boletas_extraidas_{ts}.csv"
-    out_xlsx = carpeta_salida / f"boletas_extraidas_{ts}.xlsx"
-    df.to_csv(out_csv, index=False, encoding="utf-8")
+    return out_csv if out_csv in escritos else escritos[0]
+
+
+# -----------------------------------------------------
+# Salida a base de datos (SQLite o cualquier URL de SQLAlchemy)
+# -----------------------------------------------------
+_COLUMNAS_INDICE_SQL = ("id_cliente", "nro_documento", "fecha_emision")
+
+def _clave_sql(fila: dict) -> str:
+    """Clave natural empresa|id_cliente|nro_documento; si falta alguna parte, la del archivo."""
+    clave = _clave_boleta(fila)
+    return "|".join(clave) if clave else f"archivo|{fila.get('archivo_pdf')}"
+
+def _fila_sql(fila: dict, mtime_ns: int) -> dict:
+    d = {c: fila.get(c) for c in COLUMNAS}
+    d["total_a_pagar"] = d["total_a_pagar"] if isinstance(d["total_a_pagar"], int) else None
+    d["clave"] = _clave_sql(fila)
+    d["mtime_ns"] = mtime_ns
+    return d
+
+def _ruta_sqlite(url: str) -> str | None:
+    """'sqlite:///ruta.db' o una ruta simple -> ruta; otra URL -> None (usa SQLAlchemy)."""
+    if url.startswith("sqlite:///"):
+        return url[len("sqlite:///"):]
+    if "://" not in url:
+        return url
+    return None
+
+def exportar_sql(filas: list[dict], url: str, tabla: str = "boletas", lote: int = 1000,
+                 mtimes: list[int] | None = None) -> int:
+    """
+    Inserta/actualiza las filas en 'tabla' con executemany en transacciones de 'lote' filas.
+    Upsert por clave natural (empresa, id_cliente, nro_documento), así re-procesar no duplica;
+    crea índices en id_cliente, nro_documento y fecha_emision. SQLite usa sqlite3 de la
+    biblioteca estándar; otras URLs (postgresql, mysql) requieren SQLAlchemy.
+    Con la misma regla que _deduplicar_reemitidas (OK y luego mtime del PDF, en 'mtimes'):
+    se envía una sola fila por clave y una fila ya guardada solo se reemplaza por otra
+    igual o más autoritativa (columna mtime_ns). Devuelve la cantidad de filas escritas.
+    """
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", tabla):
+        raise ValueError(f"Nombre de tabla inválido: {tabla}")
+    mtimes = mtimes if mtimes is not None else [0] * len(filas)
+    conservar = sorted(_autoritativas(filas, mtimes, _clave_sql))
+    datos = [_fila_sql(filas[i], mtimes[i]) for i in conservar]
+    ruta = _ruta_sqlite(str(url))
+    if ruta is not None:
+        _exportar_sqlite(datos, ruta, tabla, lote)
+    else:
+        _exportar_sqlalchemy(datos, str(url), tabla, lote)
+    return len(datos)
+
+def _exportar_sqlite(datos: list[dict], ruta: str, tabla: str, lote: int) -> None:
+    import sqlite3
+    columnas = ["clave"] + COLUMNAS + ["mtime_ns"]
+    con = sqlite3.connect(ruta)
     try:
-        df.to_excel(out_xlsx, index=False)
-    except Exception:
-        pass
-    return out_csv
+        with con:
+            definicion = ", ".join(
+                "clave TEXT PRIMARY KEY" if c == "clave"
+                else f"{c} {'INTEGER' if c in ('total_a_pagar', 'mtime_ns') else 'TEXT'}"
+                for c in columnas
+            )
+            con.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ({definicion})")
+            for c in _COLUMNAS_INDICE_SQL:
+                con.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabla}_{c} ON {tabla} ({c})")
+        sql = (
+            f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))}) "
+            f"ON CONFLICT(clave) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in columnas[1:])} "
+            # no pisar una fila más autoritativa (OK, o un PDF más reciente) con una copia vieja
+            f"WHERE (excluded.estado IS 'OK', excluded.mtime_ns) >= ({tabla}.estado IS 'OK', {tabla}.mtime_ns)"
+        )
+        for i in range(0, len(datos), lote):
+            with con:  # una transacción por lote
+                con.executemany(sql, [tuple(d[c] for c in columnas) for d in datos[i : i + lote]])
+    finally:
+        con.close()
+
+def _exportar_sqlalchemy(datos: list[dict], url: str, tabla: str, lote: int) -> None:
+    import sqlalchemy as sa
+    motor = sa.create_engine(url)
+    meta = sa.MetaData()
+    t = sa.Table(
+        tabla, meta,
+        sa.Column("clave", sa.String(255), primary_key=True),
+        *[
+            sa.Column(c, sa.BigInteger if c == "total_a_pagar" else sa.String(64 if c in _COLUMNAS_INDICE_SQL else 255))
+            for c in COLUMNAS
+        ],
+        sa.Column("mtime_ns", sa.BigInteger),
+        *[sa.Index(f"ix_{tabla}_{c}", c) for c in _COLUMNAS_INDICE_SQL],
+    )
+    meta.create_all(motor)
+
+    columnas = COLUMNAS + ["mtime_ns"]
+
+    def _rango(cols):
+        # (estado OK, mtime_ns): la misma prioridad que _deduplicar_reemitidas
+        return sa.tuple_(sa.func.coalesce(cols.estado, "") == "OK", cols.mtime_ns)
+
+    dialecto = motor.dialect.name
+    if dialecto in ("sqlite", "postgresql"):
+        if dialecto == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(t)
+        stmt = stmt.on_conflict_do_update(index_elements=["clave"], set_={c: stmt.excluded[c] for c in columnas},
+                                          where=_rango(stmt.excluded) >= _rango(t.c))
+    elif dialecto in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(t)
+        nueva = _rango(stmt.inserted) >= _rango(t.c)
+        # MySQL no tiene WHERE y asigna en orden (cada CASE ve lo ya asignado): mtime_ns y
+        # estado van al final, en ese orden, para que la condición siga valiendo hasta el final
+        orden = [c for c in columnas if c not in ("estado", "mtime_ns")] + ["mtime_ns", "estado"]
+        stmt = stmt.on_duplicate_key_update([(c, sa.case((nueva, stmt.inserted[c]), else_=t.c[c])) for c in orden])
+    else:
+        raise ValueError(f"Upsert no soportado para el motor '{dialecto}'")
+
+    for i in range(0, len(datos), lote):
+        with motor.begin() as con:  # una transacción por lote (executemany)
+            con.execute(stmt, datos[i : i + lote])
+    motor.dispose()
+
+
+# -----------------------------------------------------
+# Ejecución distribuida por shards (manifiesto en carpeta compartida)
+# -----------------------------------------------------
+# 1) crear_manifiesto: lista de PDFs (ruta relativa + sha256 + bytes).
+# 2) procesar_shard(k, N): cada máquina procesa los PDFs con sha256 % N == k y
+#    anota cada fila en <manifiesto>_<id>_shard_k_de_N.jsonl (reanudable); al terminar
+#    deja el marcador .done. El id sale del contenido del manifiesto, así que un
+#    manifiesto re-creado no reutiliza diarios ni marcadores del anterior.
+# 3) unir_shards(N): junta los .jsonl, deduplica por sha256 y ordena como el manifiesto;
+#    falla si algún PDF del manifiesto quedó sin fila.
+# Todo vive junto al manifiesto; no hay servicio externo, solo el sistema de archivos.
+
+def _hash_archivo(path_pdf: Path) -> str:
+    return _leer_mmap(path_pdf, con_datos=False)[1]
+
+def _escribir_json_atomico(ruta: Path, datos) -> None:
+    import json
+    tmp = ruta.with_name(ruta.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(datos, fh, ensure_ascii=False)
+    os.replace(tmp, ruta)
+
+def crear_manifiesto(carpeta_boletas: Path, ruta_manifiesto: Path) -> Path:
+    """Escribe el manifiesto JSON de la carpeta. Las rutas son relativas a la carpeta."""
+    carpeta_boletas = Path(carpeta_boletas)
+    ruta_manifiesto = Path(ruta_manifiesto)
+    entradas = []
+    for pdf, st in _escanear_pdfs(carpeta_boletas):
+        entradas.append({
+            "ruta": pdf.relative_to(carpeta_boletas).as_posix(),
+            "sha256": _hash_archivo(pdf),
+            "bytes": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+        })
+    if not entradas:
+        raise RuntimeError("No se encontraron PDFs en la carpeta.")
+    ruta_manifiesto.parent.mkdir(parents=True, exist_ok=True)
+    _escribir_json_atomico(ruta_manifiesto, {"creado": datetime.now().isoformat(timespec="seconds"),
+                                             "id": _id_manifiesto(entradas),
+                                             "archivos": entradas})
+    return ruta_manifiesto
+
+def _id_manifiesto(entradas: list[dict]) -> str:
+    """Identificador del contenido del manifiesto: cambia si cambia cualquier ruta o sha256."""
+    import hashlib
+    h = hashlib.sha256()
+    for e in entradas:
+        h.update(f"{e['ruta']}\0{e['sha256']}\n".encode("utf-8"))
+    return h.hexdigest()[:12]
+
+def _leer_manifiesto(ruta_manifiesto: Path) -> tuple[str, list[dict]]:
+    """Devuelve (id, entradas); el id se recalcula desde las entradas, no se confía en el guardado."""
+    import json
+    with open(ruta_manifiesto, encoding="utf-8") as fh:
+        entradas = json.load(fh)["archivos"]
+    return _id_manifiesto(entradas), entradas
+
+def _shard_de(sha256: str, n_shards: int) -> int:
+    return int(sha256[:12], 16) % n_shards
+
+def _rutas_shard(ruta_manifiesto: Path, id_manifiesto: str, shard: int, n_shards: int) -> tuple[Path, Path]:
+    # el id en el nombre impide mezclar shards de un manifiesto anterior con el actual
+    base = f"{ruta_manifiesto.stem}_{id_manifiesto}_shard_{shard:03d}_de_{n_shards:03d}"
+    return ruta_manifiesto.with_name(base + ".jsonl"), ruta_manifiesto.with_name(base + ".done")
+
+def _leer_diario(ruta: Path) -> list[dict]:
+    """Lee un .jsonl de filas; si la última línea quedó cortada (corte de luz, kill) la descarta del archivo."""
+    import json
+    if not ruta.exists():
+        return []
+    with open(ruta, "rb") as fh:
+        datos = fh.read()
+    completo = datos[: datos.rfind(b"\n") + 1]
+    if len(completo) != len(datos):
+        with open(ruta, "r+b") as fh:
+            fh.truncate(len(completo))
+    return [json.loads(linea) for linea in completo.decode("utf-8").splitlines() if linea.strip()]
+
+def procesar_shard(carpeta_boletas: Path, ruta_manifiesto: Path, shard: int, n_shards: int,
+                   trabajadores: int = 1, timeout: float | None = None, lote: int = 20) -> Path:
+    """
+    Procesa el shard 'shard' (0..n_shards-1) del manifiesto. 'carpeta_boletas' es la
+    raíz de los PDF vista desde esta máquina (puede diferir entre hosts).
+    Reanudable: los sha256 ya anotados en el .jsonl del shard no se vuelven a extraer
+    (salvo los que quedaron en TIMEOUT, que se reintentan).
+    """
+    import json
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"Shard fuera de rango: {shard} (n_shards={n_shards})")
+    carpeta_boletas = Path(carpeta_boletas)
+    ruta_manifiesto = Path(ruta_manifiesto)
+    id_manifiesto, entradas = _leer_manifiesto(ruta_manifiesto)
+    diario, hecho = _rutas_shard(ruta_manifiesto, id_manifiesto, shard, n_shards)
+
+    hechos = {r["sha256"] for r in _leer_diario(diario) if r["fila"]["estado"] != "TIMEOUT"}
+    pendientes = []
+    for e in entradas:
+        if _shard_de(e["sha256"], n_shards) == shard and e["sha256"] not in hechos:
+            hechos.add(e["sha256"])  # copias idénticas dentro del shard: se extrae una sola
+            pendientes.append(e)
+
+    with open(diario, "a", encoding="utf-8") as fh:
+        leidos = _precargar(((e, carpeta_boletas / e["ruta"]) for e in pendientes), con_hash=False)
+        filas = _iterar_lote(((e, ruta, datos) for e, ruta, datos, _ in leidos), trabajadores, timeout)
+        for n, (e, fila) in enumerate(filas, 1):
+            fh.write(json.dumps({"sha256": e["sha256"], "fila": fila}, ensure_ascii=False) + "\n")
+            if n % lote == 0:
+                fh.flush()
+                os.fsync(fh.fileno())
+        fh.flush()
+        os.fsync(fh.fileno())
+    hecho.touch()
+    return diario
+
+def unir_shards(ruta_manifiesto: Path, n_shards: int, carpeta_salida: Path | None = None,
+                formatos=("csv", "xlsx"), deduplicar: bool = False, agregador=None,
+                clientes=None, sql: str | None = None) -> Path:
+    """
+    Une los N shards terminados en una salida deduplicada por sha256, en el orden del manifiesto.
+    Con deduplicar=True además deja solo la versión autoritativa de boletas re-emitidas.
+    Falla si algún shard no terminó o si algún PDF del manifiesto no tiene fila.
+    """
+    ruta_manifiesto = Path(ruta_manifiesto)
+    carpeta_salida = Path(carpeta_salida) if carpeta_salida else ruta_manifiesto.parent
+    id_manifiesto, entradas = _leer_manifiesto(ruta_manifiesto)
+    rutas = [_rutas_shard(ruta_manifiesto, id_manifiesto, k, n_shards) for k in range(n_shards)]
+    faltan = [k for k, (_, hecho) in enumerate(rutas) if not hecho.exists()]
+    if faltan:
+        raise RuntimeError(f"Shards sin terminar para el manifiesto {id_manifiesto}: {faltan}")
+
+    filas = {}
+    for diario, _ in rutas:
+        for r in _leer_diario(diario):
+            # una fila TIMEOUT se reemplaza si un reintento posterior la resolvió
+            if r["sha256"] not in filas or filas[r["sha256"]]["estado"] == "TIMEOUT":
+                filas[r["sha256"]] = r["fila"]
+    resultados = []
+    mtimes = []
+    vistos = set()
+    sin_fila = [e["ruta"] for e in entradas if e["sha256"] not in filas]
+    if sin_fila:
+        raise RuntimeError(f"{len(sin_fila)} PDF del manifiesto sin fila en los shards (p. ej. {sin_fila[:5]})")
+    for e in entradas:
+        if e["sha256"] not in vistos:
+            vistos.add(e["sha256"])
+            resultados.append(filas[e["sha256"]])
+            mtimes.append(e.get("mtime_ns", 0))
+    if deduplicar:
+        resultados, mtimes = _deduplicar_reemitidas(resultados, mtimes)
+    if clientes is not None:
+        _marcar_alertas(resultados, clientes)
+    if agregador is not None:
+        for fila in resultados:
+            agregador.agregar(fila)
+    out = _escribir_salidas(resultados, carpeta_salida, _validar_formatos(formatos))
+    if sql:
+        exportar_sql(resultados, sql, mtimes=mtimes)
+    return out
+
+
+# -----------------------------------------------------
+# Línea de comandos: python -m funciones <carpeta_boletas> [opciones]
+# -----------------------------------------------------
+def main(argv: list[str] | None = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m funciones",
+        description="Extrae datos de boletas PDF (Metrogas, Enel, Aguas Andinas) a CSV/XLSX/Parquet.",
+    )
+    parser.add_argument("carpeta_boletas", type=Path, help="carpeta con los PDF")
+    parser.add_argument("-o", "--salida", type=Path, default=None,
+                        help="carpeta de salida (por defecto, la de boletas)")
+    parser.add_argument("-j", "--trabajadores", type=int, default=1,
+                        help="procesos en paralelo (default: 1)")
+    parser.add_argument("-f", "--formatos", default="csv,xlsx",
+                        help="formatos separados por coma: csv, xlsx, parquet (default: csv,xlsx)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="reutiliza filas de PDFs sin cambios desde el cache de la carpeta de salida")
+    parser.add_argument("--deduplicar", action="store_true",
+                        help="omite PDFs idénticos y deja solo la versión autoritativa de boletas re-emitidas")
+    parser.add_argument("--reanudar", action="store_true",
+                        help="continúa una corrida interrumpida desde .progreso_boletas.jsonl")
+    parser.add_argument("--resumen", action="store_true",
+                        help="escribe además resumen_<ts>.json con agregados (analitica.AgregadorBoletas)")
+    parser.add_argument("--anomalias", action="store_true",
+                        help="marca la columna 'alertas' según la historia de cada cliente "
+                             "(guardada en .clientes_boletas.json de la carpeta de salida)")
+    parser.add_argument("--sql", metavar="URL", default=None,
+                        help="además, upsert en una base SQL: ruta .db de SQLite o URL de SQLAlchemy")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="segundos máximos por archivo")
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="RUTA",
+                        help="guarda un perfil cProfile (.pstats) de la corrida")
+    distrib = parser.add_argument_group("ejecución por shards (varias máquinas, carpeta compartida)")
+    distrib.add_argument("--manifiesto", type=Path, default=None,
+                         help="ruta del manifiesto compartido (JSON)")
+    modo = distrib.add_mutually_exclusive_group()
+    modo.add_argument("--crear-manifiesto", action="store_true",
+                      help="crea el manifiesto de la carpeta de boletas")
+    modo.add_argument("--shard", metavar="K/N", default=None,
+                      help="procesa el shard K (0..N-1) de N; reanudable")
+    modo.add_argument("--unir", type=int, metavar="N", default=None,
+                      help="une los N shards terminados en la carpeta de salida")
+    args = parser.parse_args(argv)
+
+    try:
+        formatos = _validar_formatos([f.strip() for f in args.formatos.split(",") if f.strip()])
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+    if (args.crear_manifiesto or args.shard or args.unir is not None) and args.manifiesto is None:
+        parser.error("--crear-manifiesto/--shard/--unir requieren --manifiesto")
+    if (args.crear_manifiesto or args.shard) and (args.resumen or args.anomalias):
+        # esos modos no producen la salida final: el resumen y las alertas van en --unir
+        parser.error("--resumen/--anomalias solo aplican a una corrida normal o a --unir")
+    agregador = None
+    if args.resumen:
+        from analitica import AgregadorBoletas
+        agregador = AgregadorBoletas()
+    clientes = None
+    ruta_clientes = (args.salida or args.carpeta_boletas) / _ARCHIVO_CLIENTES
+    if args.anomalias:
+        from analitica import EstadoClientes
+        clientes = EstadoClientes.cargar(ruta_clientes)
+    if args.crear_manifiesto:
+        ejecutar = lambda: crear_manifiesto(args.carpeta_boletas, args.manifiesto)
+    elif args.shard:
+        try:
+            k, n = (int(x) for x in args.shard.split("/"))
+        except ValueError:
+            parser.error("--shard debe tener la forma K/N, p. ej. 3/16")
+        if n < 1 or not 0 <= k < n:
+            parser.error(f"--shard fuera de rango: {args.shard} (se espera 0 <= K < N)")
+        ejecutar = lambda: procesar_shard(args.carpeta_boletas, args.manifiesto, k, n,
+                                          trabajadores=args.trabajadores, timeout=args.timeout)
+    elif args.unir is not None:
+        if args.unir < 1:
+            parser.error("--unir requiere N >= 1")
+        ejecutar = lambda: unir_shards(args.manifiesto, args.unir, args.salida, formatos,
+                                       deduplicar=args.deduplicar, agregador=agregador,
+                                       clientes=clientes, sql=args.sql)
+    else:
+        ejecutar = lambda: procesar_boletas(
+            args.carpeta_boletas,
+            carpeta_salida=args.salida,
+            trabajadores=args.trabajadores,
+            formatos=formatos,
+            incremental=args.incremental,
+            timeout=args.timeout,
+            deduplicar=args.deduplicar,
+            reanudar=args.reanudar,
+            agregador=agregador,
+            clientes=clientes,
+            sql=args.sql,
+        )
+
+    if args.profile is None:
+        out = ejecutar()
+    else:
+        import cProfile
+        perfil = cProfile.Profile()
+        perfil.enable()
+        try:
+            out = ejecutar()
+        finally:
+            perfil.disable()
+            ruta = Path(args.profile) if args.profile else \
+                (args.salida or args.carpeta_boletas) / f"perfil_{datetime.now():%Y%m%d_%H%M%S}.pstats"
+            perfil.dump_stats(str(ruta))
+            print("Perfil:", ruta)
+    print("Salida:", out)
+    if clientes is not None:
+        (args.salida or args.carpeta_boletas).mkdir(parents=True, exist_ok=True)
+        clientes.guardar(ruta_clientes)
+    if agregador is not None:
+        ruta = agregador.exportar(out.with_name(out.stem.replace("boletas_extraidas", "resumen") + ".json"))
+        print("Resumen:", ruta)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())